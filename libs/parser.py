@@ -10,10 +10,11 @@ CALs and TAGs (The Tags show if the calibrator is N-, L-band or both)
 The night plan has to be a (.txt)-file or of a similar filetype/file
 
 This file can also be imported as a module and contains the following functions:
-    * _get_file_section - Gets a section of the (.txt)/lines
+    * _iter_sections - Lazily yields the sections of the (.txt)/lines
     * _get_targets_calibrators_tags - Creates a lists containing nested lists with the
                                       SCI, CAL and TAG information
     * parse_night_plan - Parses the night plan -> The main function of this script
+    * parse_night_plans - Parses multiple night plans in parallel
 
 Example of usage:
     >>> from parser import parse_night_plan
@@ -29,43 +30,90 @@ Example of usage:
 
 # TODO: Think about making the parsing work differently, check what readlines
 # accept -> Make similar to loadbobx, readblock and so...
+import concurrent.futures
+import functools
+import re
+
 import yaml
 
+try:
+    # NOTE: The libyaml-backed dumper is considerably faster than the pure
+    # Python one, but is only available if PyYAML was built against libyaml
+    from yaml import CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeDumper
+
+from collections import defaultdict
 from pathlib import Path
 from typing import Dict, List, Optional
 
-from utils import contains_element
+from utils import any_line_contains
 
+# NOTE: Matches an observation line, that is, a time followed by either a
+# calibrator of the 'cal_<TAG>_<NAME>' form or a (multi-word) target name
+LINE_RE = re.compile(r"^(?P<time>\d{1,2}:\d{2}) "
+                     r"(?:cal_(?P<tag>[A-Za-z]+)_(?P<calibrator>\S+)"
+                     r"|(?P<target>\S+(?: \S+){0,2}))")
 
-def _get_file_section(lines: List, identifier: str) -> Dict:
-    """Gets the section of a file corresponding to the given identifier and
-    returns a dict with the keys being the match to the identifier and the
-    values being a subset of the lines list
+
+@functools.lru_cache(maxsize=32)
+def _identifier_re(identifier: str) -> re.Pattern:
+    """Compiles (and caches) the case-insensitive pattern that matches a line
+    starting a new section for the given identifier
 
     Parameters
     ----------
-    lines: List
-        The lines read from a file
     identifier: str
-        The identifier by which they should be split into subsets
+        The identifier by which a file is split into sections
 
     Returns
-    --------
-    subset: dict
-        A dict that contains a subsets of the original lines
+    -------
+    identifier_re: re.Pattern
+        The compiled pattern anchoring the identifier at the line start
     """
-    indices, labels = [], []
-    for index, line in enumerate(lines):
-        if line.lower().startswith(identifier):
-            indices.append(index)
-            labels.append(line.replace('\n', ''))
+    # NOTE: A plain prefix, not a word boundary, since the labels continue
+    # the identifier directly, e.g. 'nights 2-4:' for the identifier 'night'
+    return re.compile(rf"^{re.escape(identifier)}", re.IGNORECASE)
+
+
+def _iter_sections(lines, identifier: str):
+    """Lazily splits the lines into sections at every line matching the given
+    identifier and yields them one at a time, so only the lines of the current
+    section are buffered
 
-    if not indices:
-        indices, labels = [0], ["full_" + identifier]
+    Parameters
+    ----------
+    lines: Iterable
+        The lines read from a file or a previously yielded section
+    identifier: str
+        The identifier by which they should be split into sections
+
+    Yields
+    ------
+    label: str
+        The line that matched the identifier, or 'full_<identifier>' if no
+        line matched at all
+    section: List
+        The lines of the section, including the matching line itself
+    """
+    # NOTE: Matching a compiled, case-insensitive pattern avoids lowering a
+    # copy of every single line just to compare its first word
+    identifier_re = _identifier_re(identifier)
+    label, section = None, []
+    for line in lines:
+        if identifier_re.match(line):
+            if label is None:
+                section = []
+            else:
+                yield label, section
+                section = []
+            label = line
+        section.append(line)
 
-    sections = [lines[index:] if index == indices[~0] else \
-                  lines[index:indices[i+1]] for i, index in enumerate(indices)]
-    return {labels: sections for (labels, sections) in zip(labels, sections)}
+    if label is not None:
+        yield label, section
+    else:
+        yield "full_" + identifier, section
 
 
 def _get_targets_calibrators_tags(lines: List):
@@ -81,64 +129,117 @@ def _get_targets_calibrators_tags(lines: List):
     Dict:
         A dictionary that contains the SCI, CAL and TAG lists
     """
-    line_start = [index for index, line in enumerate(lines) if line[0].isdigit()][0]
-    line_end = [index for index, line in enumerate(lines)\
-                if line.startswith("calibrator_find")][0]
-    lines = ['' if line == '\n' else line for line in lines[line_start:line_end]]
-
-    sci_lst, cal_lst, tag_lst  = [], [[]], [[]]
-    double_sci, counter = False, 0
-
-    for index, line in enumerate(lines):
-        try:
-            if ((line == '') or (not line.split()[0][0].isdigit()))\
-               and (lines[index+1].split()[0][0].isdigit()):
+    # NOTE: Single walk that cuts the observation block out between the first
+    # observation line and the 'calibrator_find' footer; the lines carry no
+    # terminators anymore, so empty lines need no blanking
+    collecting, cleaned = False, []
+    for line in lines:
+        if not collecting:
+            if not (line and line[0].isdigit()):
+                continue
+            collecting = True
+        if line.startswith("calibrator_find"):
+            break
+        cleaned.append(line)
+    lines = cleaned
+
+    sci_lst = []
+    cal_by_sci, tag_by_sci = defaultdict(list), defaultdict(list)
+    double_sci, counter, group_count = False, 0, 1
+
+    # NOTE: Match every line exactly once; the loop below looks at up to two
+    # neighbouring lines, which would otherwise re-match the same line thrice
+    matches = [LINE_RE.match(line) for line in lines]
+    # NOTE: A flat flag vector for the lookahead tests; indexing a bytes
+    # object is a plain array load instead of a match object truthiness check
+    is_observation = bytes(match is not None for match in matches)
+    line_count = len(lines)
+    for index, match in enumerate(matches):
+        if match is None:
+            if index + 1 < line_count and is_observation[index+1]:
                 counter += 1
-                cal_lst.append([])
-                tag_lst.append([])
+                group_count += 1
+
+        elif match.group("tag"):
+            # NOTE: Gets the CAL
+            cal_by_sci[counter].append(match.group("calibrator"))
+            tag_by_sci[counter].append(match.group("tag"))
+
+            if double_sci:
+                cal_by_sci[counter+1].append(match.group("calibrator"))
+                tag_by_sci[counter+1].append(match.group("tag"))
+                group_count += 1
+                double_sci = False
+        else:
+            # NOTE: Fixes the case where one CAL is for two SCI
+            if index + 3 < line_count:
+                next_match = matches[index+1]
+                if next_match and next_match.group("target")\
+                   and is_observation[index+2]:
+                    double_sci = True
+
+            # NOTE: Gets the SCI
+            sci_lst.append(match.group("target").strip())
+
+    # NOTE: Only materialize the per-SCI lists at the end; groups without any
+    # calibrator come out as the same empty lists as before
+    cal_lst = [cal_by_sci[group] for group in range(group_count)]
+    tag_lst = [tag_by_sci[group] for group in range(group_count)]
+    return {"SCI": sci_lst, "CAL": cal_lst, "TAG": tag_lst}
 
-            else:
-                line = line.split(' ')
-                if (line[0][0].isdigit()) and (len(line) > 2)\
-                   and (len(line[0].split(":")) == 2):
-                    # NOTE: Gets the CAL
-                    if "cal_" in line[1]:
-                        temp_cal = line[1].split("_")
-                        cal_lst[counter].append(temp_cal[2])
-                        tag_lst[counter].append(temp_cal[1])
-
-                        if double_sci:
-                            cal_lst.append([])
-                            tag_lst.append([])
-                            cal_lst[counter+1].append(temp_cal[2])
-                            tag_lst[counter+1].append(temp_cal[1])
-                            double_sci = False
-                    else:
-                        # NOTE: Fixes the case where one CAL is for two SCI
-                        if (index != len(lines)-3):
-                            try:
-                                if lines[index+1][0][0].isdigit() and\
-                                   not ("cal_" in lines[index+1].split(' ')[1]) and\
-                                   lines[index+2][0][0].isdigit():
-                                    double_sci = True
-                            except:
-                                pass
-
-                        # NOTE: Gets the SCI
-                        if line[3] != '':
-                            sci_lst.append((line[1]+' '+line[2]+' '+line[3]).strip())
-                        else:
-                            sci_lst.append((line[1]+' '+line[2]).strip())
-        except:
-            pass
 
-    return {"SCI": sci_lst, "CAL": cal_lst, "TAG": tag_lst}
+def _quote(value: str) -> str:
+    """Returns the value as a double-quoted yaml scalar"""
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _write_night_plan_yaml(night_plan_dict: Dict, yaml_file) -> None:
+    """Writes the night plan dict as yaml with a purpose-built emitter
+
+    The nesting of a parsed night plan is fixed (run -> night -> the 'SCI',
+    'CAL' and 'TAG' lists), so emitting it directly skips the generic object
+    introspection of 'yaml.dump' entirely
+
+    Parameters
+    ----------
+    night_plan_dict: Dict
+        The parsed night plan as returned by 'parse_night_plan'
+    yaml_file
+        The open, writable file the yaml is emitted to
+    """
+    # NOTE: Empty containers are written out explicitly -- a bare 'key:'
+    # would load back as None instead of an empty dict or list
+    for run, nights in night_plan_dict.items():
+        if not nights:
+            yaml_file.write(f"{_quote(run)}: {{}}\n")
+            continue
+        yaml_file.write(f"{_quote(run)}:\n")
+        for night, targets in nights.items():
+            if not targets:
+                yaml_file.write(f"  {_quote(night)}: {{}}\n")
+                continue
+            yaml_file.write(f"  {_quote(night)}:\n")
+            for category, values in targets.items():
+                if not values:
+                    yaml_file.write(f"    {category}: []\n")
+                    continue
+                yaml_file.write(f"    {category}:\n")
+                for value in values:
+                    if not isinstance(value, list):
+                        yaml_file.write(f"    - {_quote(value)}\n")
+                    elif value:
+                        yaml_file.write(f"    - - {_quote(value[0])}\n")
+                        for element in value[1:]:
+                            yaml_file.write(f"      - {_quote(element)}\n")
+                    else:
+                        yaml_file.write("    - []\n")
 
 
 def parse_night_plan(night_plan_path: Path,
                      run_identifier: Optional[str] = "run",
                      sub_identifier: Optional[str] = "night",
-                     save_path: Optional[Path] = "") -> Dict[str, List]:
+                     save_path: Optional[Path] = "",
+                     fast_yaml: Optional[bool] = False) -> Dict[str, List]:
     """Parses the night plan created with 'calibrator_find.pro' into the
     individual runs as key of a dictionary, specified by the 'run_identifier'.
     If no match is found then it parses the whole night to 'run_identifier's
@@ -157,6 +258,9 @@ def parse_night_plan(night_plan_path: Path,
     save_to_file: bool, optional
         If this is set to true then it saves the dictionary as
         'night_plan.yaml', Default is 'False'
+    fast_yaml: bool, optional
+        If this is set to true then the (.yaml)-file is written with the
+        purpose-built emitter instead of 'yaml.dump', Default is 'False'
 
     Returns
     -------
@@ -166,32 +270,117 @@ def parse_night_plan(night_plan_path: Path,
     """
     night_plan_dict = {}
     night_plan_path = Path(night_plan_path)
-    if night_plan_path.exists():
-        with open(Path(night_plan_path), "r+") as night_plan:
-            lines = night_plan.readlines()
-    else:
+    if not night_plan_path.exists():
         raise FileNotFoundError(f"File {Path(night_plan_path)} was not found/does not exist!")
 
-    runs = _get_file_section(lines, run_identifier)
-
-    for label, section in runs.items():
-        subsection_dict = _get_file_section(section, sub_identifier)
+    # NOTE: One read, one decode (ascii if possible, which most plans are)
+    # and one split without terminators, so an empty line is the empty
+    # string and the downstream blank checks are plain truthiness tests
+    data = night_plan_path.read_bytes()
+    lines = data.decode("ascii" if data.isascii() else "utf-8",
+                        "replace").splitlines()
 
+    for label, section in _iter_sections(lines, run_identifier):
         nights = {}
-        for sub_label, sub_section in subsection_dict.items():
-            if contains_element(sub_section, "cal_"):
+        for sub_label, sub_section in _iter_sections(section, sub_identifier):
+            if any_line_contains(sub_section, "cal_"):
                 nights[sub_label] = _get_targets_calibrators_tags(sub_section)
 
         night_plan_dict[label] = nights
 
     if save_path:
         yaml_file_path = Path(save_path) / "night_plan.yaml"
-        with open(yaml_file_path, "w+") as night_plan_yaml:
-            yaml.safe_dump(night_plan_dict, night_plan_yaml)
-        print(f"Created {yaml_file_path}")
+        _save_night_plan(night_plan_dict, yaml_file_path, fast_yaml)
     return night_plan_dict
 
 
+def _save_night_plan(night_plan_dict: Dict, yaml_file_path: Path,
+                     fast_yaml: Optional[bool] = False) -> None:
+    """Writes the parsed night plan to the given (.yaml)-file
+
+    Parameters
+    ----------
+    night_plan_dict: Dict
+        The parsed night plan as returned by 'parse_night_plan'
+    yaml_file_path: Path
+        The (.yaml)-file the night plan is written to
+    fast_yaml: bool, optional
+        If this is set to true then the (.yaml)-file is written with the
+        purpose-built emitter instead of 'yaml.dump', Default is 'False'
+    """
+    with open(yaml_file_path, "w+") as night_plan_yaml:
+        if fast_yaml:
+            _write_night_plan_yaml(night_plan_dict, night_plan_yaml)
+        else:
+            # NOTE: The dict is already in parse order, so skipping the
+            # key sort avoids the comparisons and keeps the night order
+            yaml.dump(night_plan_dict, night_plan_yaml, Dumper=SafeDumper,
+                      default_flow_style=False, sort_keys=False,
+                      allow_unicode=True)
+    print(f"Created {yaml_file_path}")
+
+
+def _parse_and_save(night_plan_path: Path,
+                    save_path: Optional[Path] = "",
+                    fast_yaml: Optional[bool] = False) -> Dict[str, List]:
+    """Parses a single night plan and, if a save path is given, writes it to
+    a (.yaml)-file named after the plan so concurrent workers never share an
+    output file
+
+    Parameters
+    ----------
+    night_plan_path: Path
+        The night plan of the '.txt'-file format to be read and parsed
+    save_path: Path, optional
+        The path the '<plan stem>.yaml'-file is saved to
+    fast_yaml: bool, optional
+        If this is set to true then the (.yaml)-file is written with the
+        purpose-built emitter instead of 'yaml.dump', Default is 'False'
+
+    Returns
+    -------
+    night_dict: Dict
+        The parsed night plan as returned by 'parse_night_plan'
+    """
+    night_plan_dict = parse_night_plan(night_plan_path)
+    if save_path:
+        yaml_file_path = Path(save_path)\
+                / f"{Path(night_plan_path).stem}.yaml"
+        _save_night_plan(night_plan_dict, yaml_file_path, fast_yaml)
+    return night_plan_dict
+
+
+def parse_night_plans(night_plan_paths: List[Path],
+                      save_path: Optional[Path] = "",
+                      fast_yaml: Optional[bool] = False) -> Dict[Path, Dict]:
+    """Parses multiple night plans concurrently, one process per file, and
+    returns their results keyed by path. Parsing a whole observing period
+    this way scales with the number of cores instead of running serially
+
+    Parameters
+    ----------
+    night_plan_paths: List[Path]
+        The night plans of the '.txt'-file format to be read and parsed
+    save_path: Path, optional
+        The path the (.yaml)-files are saved to, one per plan and named
+        after the plan's stem
+    fast_yaml: bool, optional
+        If this is set to true then the (.yaml)-files are written with the
+        purpose-built emitter instead of 'yaml.dump', Default is 'False'
+
+    Returns
+    -------
+    night_plan_dicts: Dict[Path, Dict]
+        A dict that contains the paths as keys and the parsed night plans
+        as values
+    """
+    parse = functools.partial(_parse_and_save, save_path=save_path,
+                              fast_yaml=fast_yaml)
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        return dict(zip(night_plan_paths,
+                        executor.map(parse, night_plan_paths)))
+
+
 # TODO: Parser is broken right now, fix!
 if __name__ == "__main__":
     data_dir = Path().home() / "Data" / "observations" / "P110"
@@ -19,7 +19,26 @@ def contains_element(list_to_search: List, element_to_search: str) -> bool:
     element_in_list: bool
         'True' if element is found, 'False' otherwise
     """
-    return any([element_to_search in element for element in list_to_search])
+    return element_to_search in list_to_search
+
+
+def any_line_contains(lines: List, substring: str) -> bool:
+    """Checks if any of the lines contains the given substring and returns
+    'True' or 'False'
+
+    Parameters
+    ----------
+    lines: List
+        The lines to be searched in
+    substring: str
+        The substring being searched for
+
+    Returns
+    -------
+    substring_in_lines: bool
+        'True' if the substring is found in a line, 'False' otherwise
+    """
+    return any(substring in line for line in lines)
 
 
 def get_password_and_username():